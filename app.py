@@ -1,62 +1,183 @@
-from fastapi import FastAPI, Form, status, Depends, Cookie, File, UploadFile
+from fastapi import FastAPI, Form, status, Depends, File, UploadFile, HTTPException
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, ORJSONResponse, Response
 from fastapi.requests import Request
-from fastapi.security import OAuth2
 from fastapi.staticfiles import StaticFiles
-from sqlite3 import Connection, Row
+from PIL import Image, ImageOps
+from sqlite3 import Connection
 from secrets import token_hex
 from passlib.hash import pbkdf2_sha256
-from typing import Annotated
+from typing import Annotated, AsyncIterator
+from contextlib import asynccontextmanager
 from uuid import uuid4
 from pathlib import Path
+import aiofiles
+from anyio import to_thread
+from hashlib import blake2b
+from threading import Lock
+from cachetools import TTLCache
 import jwt
+from jinja2 import FileSystemBytecodeCache
 
 from database import (
             get_post,
             insert_post,
             create_user,
             get_user,
-            add_like,
+            update_password,
             get_single_post,
-            check_like,
-            delete_like,
-            add_comment,
-            get_comments
+            toggle_like,
+            insert_comment,
+            get_comments,
+            initialize_database
         )
-from models import Post, UserPost, UserHashed, Like, PostId, UserPostId
+from pool import ConnectionPool, PoolExhausted
+from models import UserPost, UserHashed, Like, PostId, UserPostId
 
-app = FastAPI()
-app.mount("/static", StaticFiles(directory="static"), "static")
-connection = Connection("social.db")
-connection.row_factory = Row
+# Handlers check a connection out inside their own body, on a thread that
+# already holds a threadpool slot, and hold at most one at a time. With one
+# connection per threadpool worker a checkout therefore never waits.
+WORKER_THREADS = 40
+
+pool = ConnectionPool("social.db", min_size=2, max_size=WORKER_THREADS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # sync handlers run in anyio's threadpool, pinned to the pool size
+    to_thread.current_default_thread_limiter().total_tokens = WORKER_THREADS
+
+    with pool.connection() as connection:
+        initialize_database(connection)
+    yield
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """
+    Static files that browsers may cache forever
+
+    Uploaded images are named by uuid4 and never rewritten, so a URL always
+    serves the same bytes.
+    """
+
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.mount("/static", ImmutableStaticFiles(directory="static"), "static")
 
 templates = Jinja2Templates("./templates")
+
+# compiled templates survive restarts, and are not re-checked on disk per render
+jinja_cache = Path("./.jinja_cache")
+jinja_cache.mkdir(exist_ok=True)
+templates.env.bytecode_cache = FileSystemBytecodeCache(str(jinja_cache))
+templates.env.auto_reload = False
 JWT_KEY = "7e488e36d708c05f2bf6fccfac954d17528b888ae23fa617c818feb29cf2aea7"
 EXPIRATION_TIME = 3600
 ALGORITHM = "HS256"
 
+# fewer rounds than passlib's default keeps a login to a few ms of CPU;
+# verify() reads the rounds from the stored hash so older hashes still work
+password_hasher = pbkdf2_sha256.using(rounds=15000)
+
+# checked against when a username doesn't exist, never matches a real login.
+# Hashes from before the rounds change are rehashed on login, so every
+# stored hash converges on the same cost as this one
+DUMMY_SALT = token_hex(15)
+DUMMY_HASH = password_hasher.hash(token_hex(15) + DUMMY_SALT)
+
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+IMAGE_CHUNK_SIZE = 1 << 20
+THUMBNAIL_SIZE = (400, 400)
+
+# a small, highly compressed upload can still decode to gigabytes; Pillow
+# refuses anything over twice this, and make_thumbnail skips anything over it
+MAX_IMAGE_PIXELS = 40_000_000
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+# decoded claims keyed by a digest of the cookie, so repeat requests with
+# the same token skip the signature check and the raw token is not kept
+token_cache = TTLCache(maxsize=10_000, ttl=EXPIRATION_TIME)
+token_cache_lock = Lock()
+
 
 def decrypt_access_token(access_token: str, ):
+    key = blake2b(access_token.encode(), digest_size=16).digest()
+
+    with token_cache_lock:
+        data = token_cache.get(key)
+
+    if data is not None:
+        return data
+
     _,token = access_token.split()
     data = jwt.decode(token, JWT_KEY, algorithms=[ALGORITHM])
+
+    with token_cache_lock:
+        token_cache[key] = data
+
     return data
 
-class OAuthCookie(OAuth2):
-    def __call__(self, request: Request) -> int:
-        data = decrypt_access_token(request.cookies.get("access_token"))
-        return data["user_id"]
+def jwt_claims(request: Request) -> dict | None:
+    """
+    Decodes the access_token cookie once per request
 
+    Returns:
+        dict | None: The token claims, None when logged out or when the
+        cookie can't be decoded.
+    """
+    if not hasattr(request.state, "jwt"):
+        token = request.cookies.get("access_token")
+        request.state.jwt = None
 
-oauth_cookie = OAuthCookie()
+        if token:
+            try:
+                request.state.jwt = decrypt_access_token(token)
+            except (ValueError, jwt.InvalidTokenError):
+                # malformed, tampered or signed with an old key
+                pass
 
-@app.get("/")
-async def home(request: Request, access_token: Annotated[str | None, Cookie()]=None) -> HTMLResponse:
-    context = get_post(connection).model_dump()
-    context["login"] = False
+    return request.state.jwt
+
+
+def current_user_id(claims: dict | None=Depends(jwt_claims)) -> int:
+    if claims is None:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED)
+
+    return claims["user_id"]
 
-    if access_token:
-        context["login"] = True
+
+# rendered /posts pages for logged out visitors, keyed by cursor; the short
+# TTL bounds how stale like counts get, new posts clear it outright
+anon_posts_cache = TTLCache(maxsize=128, ttl=5)
+anon_posts_cache_lock = Lock()
+
+
+def clear_anon_posts_cache() -> None:
+    with anon_posts_cache_lock:
+        anon_posts_cache.clear()
+
+
+@app.exception_handler(PoolExhausted)
+def pool_exhausted(request: Request, exc: PoolExhausted) -> HTMLResponse:
+    return HTMLResponse(
+        "Server busy, try again shortly.",
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": "1"}
+    )
+
+@app.get("/")
+def home(
+            request: Request,
+            claims: dict | None=Depends(jwt_claims)
+        ) -> HTMLResponse:
+    # the feed itself is loaded by htmx from /posts
+    context = {"login": claims is not None}
 
     return templates.TemplateResponse(
         request, 
@@ -65,49 +186,148 @@ async def home(request: Request, access_token: Annotated[str | None, Cookie()]=N
     )
 
 @app.get("/posts")
-async def posts(
+def posts(
             request: Request,
-            access_token: Annotated[str | None, Cookie()]=None
+            cursor: int | None = None,
+            claims: dict | None=Depends(jwt_claims)
         ) -> HTMLResponse:
     user_id = None
-    if access_token:
-        user_id = decrypt_access_token(access_token)["user_id"]
+    if claims is not None:
+        user_id = claims["user_id"]
+    else:
+        with anon_posts_cache_lock:
+            body = anon_posts_cache.get(cursor)
 
-    context = get_post(connection, user_id).model_dump()
+        if body is not None:
+            return HTMLResponse(body)
 
-    if access_token:
+    # a connection is only taken on a cache miss, so cached pages are
+    # served even when the pool is busy
+    with pool.connection() as connection:
+        context = get_post(connection, user_id, cursor=cursor).model_dump()
+
+    if claims is not None:
         context["login"] = True
 
-    return templates.TemplateResponse(
+    response = templates.TemplateResponse(
         request,
         "./posts.html",
         context=context
     )
 
+    if user_id is None:
+        with anon_posts_cache_lock:
+            anon_posts_cache[cursor] = response.body
+
+    return response
+
+
+def insert_pooled_post(post: UserPostId) -> int:
+    with pool.connection() as connection:
+        return insert_post(connection, post)
+
+
+async def save_upload(upload: UploadFile, path: Path) -> bool:
+    """
+    Streams an uploaded file to disk in fixed size chunks
+
+    Arguments:
+        upload (UploadFile): The uploaded file
+        path (Path): Where to write it
+
+    Returns:
+        bool: False if the upload is over MAX_IMAGE_SIZE, nothing is kept.
+    """
+    if upload.size is not None and upload.size > MAX_IMAGE_SIZE:
+        return False
+
+    written = 0
+    async with aiofiles.open(path, "wb") as file:
+        while chunk := await upload.read(IMAGE_CHUNK_SIZE):
+            written += len(chunk)
+
+            # the size header can be missing, so check as we go as well
+            if written > MAX_IMAGE_SIZE:
+                break
+
+            await file.write(chunk)
+
+    if written > MAX_IMAGE_SIZE:
+        path.unlink(missing_ok=True)
+        return False
+
+    return True
+
+
+def make_thumbnail(image_path: Path) -> str | None:
+    """
+    Writes a WebP thumbnail next to an uploaded image
+
+    Arguments:
+        image_path (Path): The saved upload
+
+    Returns:
+        str | None: The thumbnail file name, None if no thumbnail was made.
+    """
+    thumbnail_path = image_path.with_name(f"{image_path.name}.webp")
+
+    try:
+        # open() only reads the header, so oversized images are turned away
+        # before any pixels are decoded
+        with Image.open(image_path) as image:
+            if image.width * image.height > MAX_IMAGE_PIXELS:
+                return None
+
+            # WebP drops the EXIF orientation tag, so bake the rotation into
+            # the pixels or phone photos come out sideways
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail(THUMBNAIL_SIZE)
+            image.save(thumbnail_path, "WEBP", quality=80)
+    except Exception:
+        # the thumbnail is best effort: unreadable files, decompression bombs
+        # (DecompressionBombError is not an OSError) and any other decoder
+        # failure still create the post with the original image; drop
+        # anything a failed save left behind
+        thumbnail_path.unlink(missing_ok=True)
+        return None
+
+    return thumbnail_path.name
+
 
 @app.post("/post")
 async def add_post(post_title: Annotated[str, Form()],
                    post_text: Annotated[str, Form()],
                    request: Request,
                    post_image: UploadFile|None = File(None),
-                   user_id: int=Depends(oauth_cookie)
+                   user_id: int=Depends(current_user_id)
                 ) -> HTMLResponse:
     
     image_path = None
+    thumbnail = None
 
     if post_image is not None:
         image_path = Path("./static/images") / uuid4().hex
-        image_data = await post_image.read()
-        image_path.write_bytes(image_data)
+
+        if not await save_upload(post_image, image_path):
+            return templates.TemplateResponse(
+                request,
+                "./add_post.html",
+                context={"image_too_large": True}
+            )
+
+        thumbnail = await to_thread.run_sync(make_thumbnail, image_path)
         image_path = image_path.name
 
     post = UserPostId(
                     user_id=user_id,
                     post_title=post_title,
                     post_text=post_text,
-                    post_image=image_path
+                    post_image=image_path,
+                    post_thumbnail=thumbnail
                 )
-    insert_post(connection, post)
+    # only hold a pooled connection for the insert, not the upload
+    await to_thread.run_sync(insert_pooled_post, post)
+    clear_anon_posts_cache()
     context = {"post_added": True}
 
     return templates.TemplateResponse(
@@ -118,23 +338,41 @@ async def add_post(post_title: Annotated[str, Form()],
 
 
 @app.get("/login")
-async def login(request: Request) -> HTMLResponse:
+def login(request: Request) -> HTMLResponse:
     context = {"login": True}
     return templates.TemplateResponse(request, "./login.html", context=context)
 
 
 @app.post("/login")
-async def add_user(username: Annotated[str, Form()], password: Annotated[str, Form()], request: Request) -> HTMLResponse:
-    user = get_user(connection, username)
-    correct_password = pbkdf2_sha256.verify(password + user.salt, user.hash_password)
+def add_user(
+                username: Annotated[str, Form()],
+                password: Annotated[str, Form()],
+                request: Request
+            ) -> HTMLResponse:
+    with pool.connection() as connection:
+        user = get_user(connection, username)
+
+    if user is None:
+        # do the same pbkdf2 work as a real check, so a missing username
+        # can't be told apart by how long the response takes
+        password_hasher.verify(password + DUMMY_SALT, DUMMY_HASH)
+        correct_password = False
+    else:
+        correct_password = password_hasher.verify(password + user.salt, user.hash_password)
 
-    if user is None or not correct_password:
+    if not correct_password:
         return templates.TemplateResponse(
                         request,
                         "./login.html",
                         context={"incorrect": True}
                     )
 
+    if password_hasher.needs_update(user.hash_password):
+        hash_password = password_hasher.hash(password + user.salt)
+
+        with pool.connection() as connection:
+            update_password(connection, user, hash_password)
+
     token = jwt.encode({
         "username": username,
         "user_id" : user.user_id
@@ -157,7 +395,7 @@ async def add_user(username: Annotated[str, Form()], password: Annotated[str, Fo
 
 
 @app.get("/logout")
-async def logout(response: RedirectResponse) -> HTMLResponse:
+def logout(response: RedirectResponse) -> HTMLResponse:
     response = RedirectResponse("./login")
     response.delete_cookie("access_token")
 
@@ -165,14 +403,21 @@ async def logout(response: RedirectResponse) -> HTMLResponse:
 
 
 @app.get("/signup")
-async def signup(request: Request) -> HTMLResponse:
+def signup(request: Request) -> HTMLResponse:
     context = {"login": False}
     return templates.TemplateResponse(request, "./signup.html", context=context)
 
 
 @app.post("/signup")
-async def add_user(username: Annotated[str, Form()], password: Annotated[str, Form()], request: Request) -> HTMLResponse:
-    if get_user(connection, username) is not None:
+def add_user(
+                username: Annotated[str, Form()],
+                password: Annotated[str, Form()],
+                request: Request
+            ) -> HTMLResponse:
+    with pool.connection() as connection:
+        user = get_user(connection, username)
+
+    if user is not None:
         return templates.TemplateResponse(
                         request,
                         "./signup.html",
@@ -183,7 +428,7 @@ async def add_user(username: Annotated[str, Form()], password: Annotated[str, Fo
     salt = token_hex(hex_int)
     
     # hashs user password
-    hash_password = pbkdf2_sha256.hash(password + salt)   
+    hash_password = password_hasher.hash(password + salt)
 
     # update db
     hashed_user = UserHashed(
@@ -192,37 +437,38 @@ async def add_user(username: Annotated[str, Form()], password: Annotated[str, Fo
                     hash_password=hash_password
                 )
     
-    create_user(connection, hashed_user)
+    with pool.connection() as connection:
+        create_user(connection, hashed_user)
 
     return RedirectResponse("./login", status.HTTP_303_SEE_OTHER)
 
 
 @app.post("/like")
-async def upload_like(
+def upload_like(
                     post_id: PostId,
                     request: Request, 
-                    user_id: int=Depends(oauth_cookie),
+                    user_id: int=Depends(current_user_id)
                 ) -> HTMLResponse:
     like = Like(user_id=user_id, post_id=post_id.post_id)
 
-    if check_like(connection, like):
-        delete_like(connection, like)
-    else:
-        add_like(connection, like)
+    with pool.connection() as connection:
+        toggle_like(connection, like)
+        context = get_single_post(connection, post_id.post_id, user_id).model_dump()
 
-    context = get_single_post(connection, post_id.post_id, user_id).model_dump()
     context = {"post": context}
     context["login"] = True
     return templates.TemplateResponse(request, "./post.html", context=context)
 
 @app.get("/add_comment_form_{post_id}")
-async def add_comment_form(
+def add_comment_form(
                         post_id: int,
                         request: Request,
-                        user_id: int=Depends(oauth_cookie)
+                        user_id: int=Depends(current_user_id)
                     ) -> HTMLResponse:
     
-    context = get_single_post(connection, post_id, user_id).model_dump()
+    with pool.connection() as connection:
+        context = get_single_post(connection, post_id, user_id).model_dump()
+
     context = {"post": context}
     context["comment_form"] = True
     context["login"] = True
@@ -231,18 +477,20 @@ async def add_comment_form(
 
 
 @app.post("/add_comment_{post_id}")
-async def add_comment_form(
+def add_comment_form(
                         post_id: int,
                         request: Request,
                         post: UserPost,
-                        user_id: int=Depends(oauth_cookie)
+                        user_id: int=Depends(current_user_id)
                     ) -> HTMLResponse:
     
     post = UserPostId(user_id=user_id, **post.model_dump())
-    comment_id = insert_post(connection, post)
-    add_comment(connection, comment_id, post_id)
 
-    context = get_single_post(connection, post_id, user_id).model_dump()
+    with pool.connection() as connection:
+        insert_comment(connection, post, post_id)
+        clear_anon_posts_cache()
+        context = get_single_post(connection, post_id, user_id).model_dump()
+
     context = {"post": context}
     context["comment_form"] = False
     context["login"] = True
@@ -251,15 +499,16 @@ async def add_comment_form(
 
 
 def get_comment_thread_helper(
-                            access_token: str|None,
+                            connection: Connection,
+                            claims: dict|None,
                             post_id: int,
                             hide: bool=False
                         ) -> dict:
     user_id = None
     context = {}
 
-    if access_token:
-        user_id = decrypt_access_token(access_token)["user_id"]
+    if claims is not None:
+        user_id = claims["user_id"]
         context["login"] = True
 
     context["main_post"] =  {"posts": [get_single_post(connection, post_id, user_id).model_dump()]}
@@ -275,24 +524,26 @@ def get_comment_thread_helper(
 
 
 @app.get("/get_thread{post_id}")
-async def get_thread(
+def get_thread(
                     post_id: int,
                     request: Request,
-                    access_token: Annotated[str|None, Cookie()]=None
+                    claims: dict|None=Depends(jwt_claims)
                 ) -> HTMLResponse:
     
-    context = get_comment_thread_helper(access_token, post_id)
+    with pool.connection() as connection:
+        context = get_comment_thread_helper(connection, claims, post_id)
 
     return templates.TemplateResponse(request, "./comment_thread.html", context=context)
 
 
 @app.get("/hide_thread{post_id}")
-async def hide_thread(
+def hide_thread(
                     post_id: int,
                     request: Request,
-                    access_token: Annotated[str|None, Cookie()]=None
+                    claims: dict|None=Depends(jwt_claims)
                 ) -> HTMLResponse:
     
-    context = get_comment_thread_helper(access_token, post_id, hide=True)
+    with pool.connection() as connection:
+        context = get_comment_thread_helper(connection, claims, post_id, hide=True)
 
     return templates.TemplateResponse(request, "./comment_thread.html", context=context)
\ No newline at end of file
@@ -1,83 +1,211 @@
+import sys
 import sqlite3
 from sqlite3 import Connection
-from typing import Union
+from threading import Lock
+from typing import List, Union
+
+from cachetools import TTLCache
+
+from models import Post, Posts, UserHashed, UserHashedIndex, UserPostId, Like
+
+# Hot read queries live at module level so every call hands sqlite3 the
+# same string object and hits its per-connection prepared statement cache
+# instead of re-parsing and re-planning the SQL on each request.
+
+# Every post query returns the same columns. The per-user "liked" lookup
+# only makes sense with a user_id, so each query is built twice: with the
+# lookup for logged in users and with a constant NULL for anonymous ones.
+
+_USER_LIKED_AUTH = """(
+            SELECT user_id FROM likes
+            WHERE post_id = p.post_id AND user_id = :user_id
+            LIMIT 1
+        )"""
+
+_USER_LIKED_ANON = "NULL"
+
+_POST_COLUMNS = """
+        p.post_title,
+        p.post_text,
+        p.user_id,
+        p.post_image,
+        (
+            SELECT COUNT(*) FROM likes
+            WHERE post_id = p.post_id
+        ) num_likes,
+        p.post_id,
+        {user_liked} user_liked,
+        (
+            -- comments columns are declared without a type, the unary +
+            -- drops p.post_id's affinity so the post_for_id index is used
+            SELECT COUNT(*) FROM comments
+            WHERE post_for_id = +p.post_id
+        ) number_comments,
+        p.post_thumbnail"""
+
+_GET_POST = """
+    SELECT {columns}
+    FROM posts p
+    -- no cursor means start from the newest post, written as a bound
+    -- rather than an OR so the rowid range seek still applies
+    WHERE p.post_id < COALESCE(:cursor, 9223372036854775807)
+    ORDER BY p.post_id DESC
+    LIMIT :limit;
+"""
+
+_GET_SINGLE_POST = """
+    SELECT {columns}
+    FROM posts p
+    WHERE p.post_id = :post_id;
+"""
+
+_GET_COMMENTS = """
+    SELECT {columns}
+    FROM comments c
+    JOIN posts p ON (p.post_id = c.post_id)
+    WHERE c.post_for_id = :post_id
+    ORDER BY p.post_id;
+"""
+
+
+def _build_query(template: str, user_liked: str) -> str:
+    # interned once at import, so the statement cache lookup on execute hits
+    # an already hashed string that compares equal by identity
+    return sys.intern(
+        template.format(columns=_POST_COLUMNS.format(user_liked=user_liked))
+    )
+
+
+SQL_GET_POST_AUTH = _build_query(_GET_POST, _USER_LIKED_AUTH)
+SQL_GET_POST_ANON = _build_query(_GET_POST, _USER_LIKED_ANON)
+
+SQL_GET_SINGLE_POST_AUTH = _build_query(_GET_SINGLE_POST, _USER_LIKED_AUTH)
+SQL_GET_SINGLE_POST_ANON = _build_query(_GET_SINGLE_POST, _USER_LIKED_ANON)
+
+SQL_GET_COMMENTS_AUTH = _build_query(_GET_COMMENTS, _USER_LIKED_AUTH)
+SQL_GET_COMMENTS_ANON = _build_query(_GET_COMMENTS, _USER_LIKED_ANON)
+
+SQL_INSERT_POST = """
+    INSERT INTO posts (post_title, post_text, user_id, post_image, post_thumbnail)
+    VALUES
+    ( :post_title, :post_text, :user_id, :post_image, :post_thumbnail)
+"""
+
+# Run on every new connection, in one executescript call. WAL lets readers
+# run alongside a writer and makes commits cheap; mmap_size gives 256MB of
+# memory-mapped reads and cache_size ~64MB of page cache (negative is KiB).
+SQL_CONNECTION_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA wal_autocheckpoint=1000;
+    PRAGMA busy_timeout=5000;
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-65536;
+    PRAGMA temp_store=MEMORY;
+"""
+
+# Run at startup when posts predates the thumbnail column, mirrors
+# migrations/add_thumbnails.sql
+SQL_ADD_POST_THUMBNAIL = "ALTER TABLE posts ADD COLUMN post_thumbnail TEXT;"
+
+# Run once at startup. The indexes mirror migrations/create_index.sql so a
+# fresh or un-migrated db gets them. likes (user_id, post_id) is already
+# covered by the table's primary key and posts.post_id is the rowid.
+SQL_STARTUP = """
+    BEGIN;
+    CREATE INDEX IF NOT EXISTS username_index ON users (username);
+    CREATE INDEX IF NOT EXISTS user_post_index ON posts (user_id);
+    CREATE INDEX IF NOT EXISTS like_post_id ON likes (post_id);
+    CREATE INDEX IF NOT EXISTS like_user_id ON likes (user_id);
+    CREATE INDEX IF NOT EXISTS comment_post_for_id ON comments (post_for_id);
+    COMMIT;
+"""
+
+
+def _post_row_factory(cursor: sqlite3.Cursor, row: tuple) -> Post:
+    # set as the cursor's row_factory so sqlite3's fetch loop hands back
+    # Post objects directly; column order and types are fixed by the queries
+    # above, so pydantic validation is skipped
+    return Post.model_construct(
+        post_title=row[0],
+        post_text=row[1],
+        user_id=row[2],
+        post_image=row[3],
+        num_likes=row[4],
+        post_id=row[5],
+        user_liked=row[6],
+        number_comments=row[7],
+        post_thumbnail=row[8]
+    )
+
+
+def configure_connection(connection: Connection) -> None:
+    """
+    Applies per-connection tuning PRAGMAs
+
+    Arguments:
+        connection (Connection): An active SQLite db connection
+    """
+    connection.executescript(SQL_CONNECTION_PRAGMAS)
+
+
+def _post_columns(connection: Connection) -> set:
+    return {column[1] for column in connection.execute("PRAGMA table_info(posts)")}
+
+
+def initialize_database(connection: Connection) -> None:
+    """
+    Adds columns newer code depends on (see migrations/add_thumbnails.sql)
+    and creates the indexes used by the post, like and comment lookups in a
+    single transaction
+
+    Arguments:
+        connection (Connection): An active SQLite db connection
+    """
+    if "post_thumbnail" not in _post_columns(connection):
+        try:
+            connection.execute(SQL_ADD_POST_THUMBNAIL)
+        except sqlite3.OperationalError:
+            # another worker starting up at the same time may have won
+            if "post_thumbnail" not in _post_columns(connection):
+                raise
+
+    connection.executescript(SQL_STARTUP)
 
-from models import Post, Posts, UserHashed, UserHashedIndex, Like
 
 def get_post(
         connection: Connection,
         user_id: int | None = None,
         limit: int=10,
-        page: int=0) -> Posts:
+        cursor: int | None = None) -> Posts:
     """
-    Fetches all posts from the "posts" table
+    Fetches a page of posts from the "posts" table, newest first
 
     Arguments:
        connection (COnnection): An active SQLite db connection
+       cursor (int | None): Only return posts older than this post_id
 
     Returns:
-        List[tuple]: A list of tuples containing attributes.
+        Posts: The page of posts and the cursor for the next page.
     """
 
-    offset = limit * page
+    cur = connection.cursor()
+    cur.row_factory = _post_row_factory
+    cur.execute(
+        SQL_GET_POST_ANON if user_id is None else SQL_GET_POST_AUTH,
+        {
+            "limit"  : limit,
+            "cursor" : cursor,
+            "user_id": user_id
+        }
+    )
 
-    with connection:
-        cur = connection.cursor()
-        cur.execute(
-            """
-            WITH post_page AS (
-                SELECT 
-                    post_id,
-                    post_title,
-                    post_text,
-                    user_id,
-                    post_image
-                FROM posts
-                LIMIT :limit
-                OFFSET :offset
-            ),
-            like_count AS (
-                SELECT post_id, COUNT(*) num_likes
-                FROM likes
-                WHERE post_id IN (SELECT post_id FROM post_page)
-                GROUP BY post_id
-            ),
-            user_liked AS (
-                SELECT post_id, user_id
-                FROM likes
-                WHERE user_id = :user_id
-                AND post_id IN (SELECT post_id FROM post_page)
-            ),
-            num_comments AS (
-                SELECT post_for_id, COUNT(*) number_comments
-                FROM comments
-                GROUP BY 1
-            )
-            SELECT 
-                post_title,
-                post_text,
-                p.user_id user_id,
-                post_image,
-                num_likes,
-                p.post_id post_id,
-                u.user_id user_liked,
-                number_comments
-            FROM post_page p
-            LEFT JOIN like_count l
-            USING (post_id)
-            LEFT JOIN user_liked u
-            USING (post_id)
-            LEFT JOIN num_comments AS n
-            ON (p.post_id = n.post_for_id);
-            """,
-            {
-                "limit"  : limit,
-                "offset" : offset,
-                "user_id": user_id
-            }
-        )
+    posts = cur.fetchall()
+
+    # a short page means there is nothing older left to fetch
+    next_cursor = posts[-1].post_id if len(posts) == limit else None
 
-        return Posts(posts=[Post.model_validate(dict(post)) for post in cur])
+    return Posts.model_construct(posts=posts, next_cursor=next_cursor)
 
 
 def get_single_post(
@@ -94,56 +222,17 @@ def get_single_post(
         List[tuple]: A list of tuples containing attributes.
     """
 
-    with connection:
-        cur = connection.cursor()
-        cur.execute(
-            """
-            WITH post_page AS (
-                SELECT 
-                    post_id,
-                    post_title,
-                    post_text,
-                    user_id,
-                    post_image
-                FROM posts
-                WHERE post_id = :post_id
-            ),
-            like_count AS (
-                SELECT DISTINCT post_id, COUNT(*) num_likes
-                FROM likes
-                WHERE post_id = :post_id
-            ),
-            user_liked AS (
-                SELECT post_id, user_id user_liked
-                FROM likes
-                WHERE user_id = :user_id AND post_id = :post_id
-            ),
-            num_comments AS (
-                SELECT DISTINCT post_for_id, COUNT(*) number_comments
-                FROM comments
-                WHERE post_for_id = :post_id
-            )
-            SELECT 
-                post_title,
-                post_text,
-                p.user_id user_id,
-                post_image,
-                num_likes,
-                p.post_id post_id,
-                user_liked,
-                number_comments
-            FROM post_page p
-            LEFT JOIN like_count l USING (post_id)
-            LEFT JOIN user_liked u USING (post_id)
-            LEFT JOIN num_comments c ON (p.post_id = c.post_for_id );
-            """,
-            {
-                "post_id": post_id,
-                "user_id": user_id
-            }
-        )
+    cur = connection.cursor()
+    cur.row_factory = _post_row_factory
+    cur.execute(
+        SQL_GET_SINGLE_POST_ANON if user_id is None else SQL_GET_SINGLE_POST_AUTH,
+        {
+            "post_id": post_id,
+            "user_id": user_id
+        }
+    )
 
-        return Post.model_validate(dict(cur.fetchone()))
+    return cur.fetchone()
     
 
 def insert_post(connection: Connection, post: Post) -> None:
@@ -159,16 +248,58 @@ def insert_post(connection: Connection, post: Post) -> None:
         cur = connection.cursor()
 
         # execute commands (queries)
+        cur.execute(SQL_INSERT_POST, post.model_dump())
+
+    return cur.lastrowid
+
+
+def insert_posts(connection: Connection, posts: List[UserPostId]) -> None:
+    """
+    Inserts several posts in the "posts" table in a single transaction
+
+    Arguments:
+        connection (Connection): An active SQLite db connection
+        posts (List[UserPostId]): The posts to insert
+    """
+    with connection:
+        connection.executemany(
+            SQL_INSERT_POST,
+            [post.model_dump() for post in posts]
+        )
+
+
+def insert_comment(
+                connection: Connection,
+                post: UserPostId,
+                post_for_id: int
+            ) -> int:
+    """
+    Inserts a comment post and links it to its parent in one transaction
+
+    Arguments:
+        connection (Connection): An active SQLite db connection
+        post (UserPostId): The comment to insert
+        post_for_id (int): The post_id of the post being commented on
+
+    Returns:
+        int: The post_id of the new comment.
+    """
+    with connection:
+        cur = connection.cursor()
+        cur.execute(SQL_INSERT_POST, post.model_dump())
+        comment_id = cur.lastrowid
         cur.execute(
-            """
-            INSERT INTO posts (post_title, post_text, user_id, post_image)
-            VALUES
-            ( :post_title, :post_text, :user_id, :post_image)
-            """,
-            post.model_dump()
+            "INSERT INTO comments (post_id, post_for_id) VALUES (?, ?)",
+            (comment_id, post_for_id)
         )
 
-    return cur.lastrowid
+    return comment_id
+
+
+# username -> UserHashedIndex for users that exist. Misses are never cached,
+# so a signup on any worker is visible to every other worker straight away
+_user_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+_user_cache_lock = Lock()
 
 
 def create_user(connection: Connection, user: UserHashed) -> bool:
@@ -187,157 +318,115 @@ def create_user(connection: Connection, user: UserHashed) -> bool:
     return True
 
 
-def get_user(connection: Connection, username: str) -> Union[UserHashedIndex, None]:
+def update_password(
+                connection: Connection,
+                user: UserHashedIndex,
+                hash_password: str
+            ) -> None:
     with connection:
-        cur = connection.cursor()
-
-        cur.execute(
-            """
-            SELECT
-                user_id,
-                username,
-                salt,
-                hash_password
-            FROM users
-            WHERE username = ?
-            """,
-            (username,),
+        connection.execute(
+            "UPDATE users SET hash_password = ? WHERE user_id = ?",
+            (hash_password, user.user_id)
         )
 
+    with _user_cache_lock:
+        _user_cache.pop(user.username, None)
+
+
+def get_user(connection: Connection, username: str) -> Union[UserHashedIndex, None]:
+    with _user_cache_lock:
+        cached_user = _user_cache.get(username)
+
+    if cached_user is not None:
+        return cached_user
+
+    cur = connection.cursor()
+    cur.execute(
+        """
+        SELECT
+            user_id,
+            username,
+            salt,
+            hash_password
+        FROM users
+        WHERE username = ?
+        """,
+        (username,),
+    )
+
     user = cur.fetchone()
     if user is None:
         return None
     
-    return UserHashedIndex(**dict(user))
+    user = UserHashedIndex(**dict(user))
 
+    with _user_cache_lock:
+        _user_cache[username] = user
 
-def add_like(connection: Connection, like: Like) -> None:
-    with connection:
-        cur = connection.cursor()
-
-        cur.execute(
-            """
-            INSERT INTO likes (user_id, post_id)
-            VALUES ( :user_id, :post_id);
-            """,
-            like.model_dump()
-        )
+    return user
 
 
-def add_comment(
-                connection: Connection,
-                post_id: int,
-                post_for_id: int
-            ) -> None:
-    
-    with connection:
-        cur = connection.cursor()
-        cur.execute("INSERT INTO comments (post_id, post_for_id) VALUES (?, ?)",
-                    (post_id, post_for_id)
-                )
-        
-
 def get_comments(
                 connection: Connection,
                 post_id: int,
                 user_id: int|None
             ) -> Posts:
 
-    with connection:
-        cur = connection.cursor()
-        cur.execute(
-            """
-            WITH get_comments AS(
-                SELECT post_id, post_for_id
-                FROM comments
-                WHERE post_for_id = :post_id
-            ),
-            post_page AS (
-                SELECT 
-                    post_id,
-                    post_title,
-                    post_text,
-                    user_id,
-                    post_image
-                FROM posts
-                WHERE post_id IN (SELECT post_id FROM get_comments)
-            ),
-            like_count AS (
-                SELECT DISTINCT post_id, COUNT(*) num_likes
-                FROM likes
-                WHERE post_id IN (SELECT post_id FROM get_comments)
-                GROUP BY 1
-            ),
-            user_liked AS (
-                SELECT post_id, user_id
-                FROM likes
-                WHERE user_id = :user_id
-                AND post_id IN (SELECT post_id FROM get_comments)
-            ),
-            num_comments AS (
-                SELECT DISTINCT post_for_id, COUNT(*) number_comments
-                FROM comments
-                WHERE post_for_id IN (SELECT post_id FROM get_comments)
-            )
-            SELECT 
-                post_title,
-                post_text,
-                p.user_id user_id,
-                post_image,
-                num_likes,
-                p.post_id post_id,
-                u.user_id user_liked,
-                number_comments
-            FROM post_page p
-            LEFT JOIN like_count l USING (post_id)
-            LEFT JOIN user_liked u USING (post_id)
-            LEFT JOIN num_comments c ON (p.post_id = c.post_for_id);
-            """,
-            {
-                "post_id": post_id,
-                "user_id": user_id
-            }
-        )
+    cur = connection.cursor()
+    cur.row_factory = _post_row_factory
+    cur.execute(
+        SQL_GET_COMMENTS_ANON if user_id is None else SQL_GET_COMMENTS_AUTH,
+        {
+            "post_id": post_id,
+            "user_id": user_id
+        }
+    )
 
-        return Posts(posts=[Post.model_validate(dict(post)) for post in cur])
+    return Posts.model_construct(posts=cur.fetchall())
         
 
 
-def check_like(
+def toggle_like(
                 connection: Connection,
-                like: Like    
+                like: Like
             ) -> bool:
-    cur = connection.cursor()
-    cur.execute(
-        """
-        SELECT * FROM likes
-        WHERE user_id = :user_id
-        AND post_id = :post_id;
-        """,
-        like.model_dump()
-    )
+    """
+    Removes the like if it exists, adds it otherwise
 
-    return True if cur.fetchone() is not None else False
+    Arguments:
+        connection (Connection): An active SQLite db connection
+        like (Like): The user and post to toggle
 
+    Returns:
+        bool: True if the post is now liked by the user.
+    """
+    with connection:
+        cur = connection.cursor()
+        cur.execute(
+            """
+            DELETE FROM likes
+            WHERE user_id = :user_id
+            AND post_id = :post_id
+            RETURNING 1;
+            """,
+            like.model_dump()
+        )
 
-def delete_like(
-                connection: Connection,
-                like: Like
-            ) -> None:
-    
-    cur = connection.cursor()
-    cur.execute(
-        """
-        DELETE FROM likes
-        WHERE user_id = :user_id
-        AND post_id = :post_id;
-        """,
-        like.model_dump()
-    )
+        if cur.fetchone() is not None:
+            return False
 
-if __name__ == "__main__":    
-    connection = sqlite3.connect("social.db")   # create connection with the db
+        cur.execute(
+            """
+            INSERT INTO likes (user_id, post_id)
+            VALUES ( :user_id, :post_id);
+            """,
+            like.model_dump()
+        )
 
-    connection.row_factory = sqlite3.Row    # allows fetching rows as dict-like objects instead of plain tuples
+    return True
 
-    print(get_user)
\ No newline at end of file
+if __name__ == "__main__":
+    connection = sqlite3.connect("social.db")   # create connection with the db
+    configure_connection(connection)
+    initialize_database(connection)
+    connection.close()
@@ -0,0 +1 @@
+ALTER TABLE posts ADD COLUMN post_thumbnail TEXT;
\ No newline at end of file
@@ -11,6 +11,7 @@ class UserPost(BaseModel):
 class UserPostId(UserPost):
     user_id: int
     post_image: str|None = None
+    post_thumbnail: str|None = None
 
 
 class Post(UserPost):
@@ -18,10 +19,12 @@ class Post(UserPost):
     post_id: int
     user_liked: int|None = None
     number_comments: int|None
+    post_thumbnail: str|None = None
 
 
 class Posts(BaseModel):
     posts: List[Post]
+    next_cursor: int|None = None
 
 
 class PostId(BaseModel):
@@ -0,0 +1,106 @@
+import sqlite3
+from sqlite3 import Connection, Row
+from contextlib import contextmanager
+from queue import Queue, Empty, Full
+from threading import Lock
+from typing import Iterator
+
+from database import configure_connection
+
+
+class PoolExhausted(Exception):
+    """Raised when no connection frees up within the pool's timeout"""
+
+
+class ConnectionPool:
+    """
+    A small thread-safe pool of SQLite connections
+
+    Connections are opened lazily up to `max_size` and handed out to one
+    request at a time, so handlers never share a connection concurrently.
+
+    Arguments:
+        database (str): Path to the SQLite db file
+        min_size (int): Connections opened up front
+        max_size (int): Upper bound on open connections
+        timeout (float): Seconds to wait for a free connection
+        cached_statements (int): Prepared statements kept per connection
+    """
+
+    def __init__(
+            self,
+            database: str,
+            min_size: int=2,
+            max_size: int=10,
+            timeout: float=5.0,
+            cached_statements: int=128) -> None:
+        self.database = database
+        self.cached_statements = cached_statements
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle: Queue[Connection] = Queue(maxsize=max_size)
+        self._opened = 0
+        self._lock = Lock()
+
+        for _ in range(min_size):
+            self._opened += 1
+            self._idle.put_nowait(self._open())
+
+    def _open(self) -> Connection:
+        # connections hop between threadpool workers, the pool guarantees
+        # exclusive use so the same-thread check is not needed
+        connection = sqlite3.connect(
+                        self.database,
+                        check_same_thread=False,
+                        cached_statements=self.cached_statements
+                    )
+        connection.row_factory = Row
+        configure_connection(connection)
+
+        return connection
+
+    def acquire(self) -> Connection:
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+
+        with self._lock:
+            can_open = self._opened < self.max_size
+            if can_open:
+                self._opened += 1
+
+        if can_open:
+            try:
+                return self._open()
+            except sqlite3.Error:
+                with self._lock:
+                    self._opened -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except Empty:
+            raise PoolExhausted(
+                f"no free connection after {self.timeout}s"
+            ) from None
+
+    def release(self, connection: Connection) -> None:
+        # never hand out a connection with a half-finished transaction
+        if connection.in_transaction:
+            connection.rollback()
+
+        try:
+            self._idle.put_nowait(connection)
+        except Full:
+            connection.close()
+            with self._lock:
+                self._opened -= 1
+
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)